@@ -1,7 +1,10 @@
 import os
 import csv
 import sys
+import hashlib
+import tempfile
 import traceback
+from collections import OrderedDict
 from pathlib import Path
 
 import cv2
@@ -33,13 +36,36 @@ class AutoMarker(QtCore.QThread):
 
 
 class ImageWidget(QtWidgets.QWidget):
+    # ミップマップの最小幅
+    PYRAMID_MIN_WIDTH = 256
+    # ホイール1段あたりのズーム倍率
+    ZOOM_STEP = 1.25
+
+    imageChanged = QtCore.pyqtSignal(object)
+
     def __init__(self, parent=None, image=None, ratio=1.0):
         super(ImageWidget, self).__init__(parent=parent)
-        self.image = image
         self.ratio = ratio
+        self.zoom = 1.0
+        self.offset = QtCore.QPoint(0, 0)
+        self.drag = None
+        self.image = None
+        self.pyramid = []
+        self.cache = None
+        self.cache_key = None
+        self.imageChanged.connect(self.replaceImage)
+        self.setImage(image)
 
     def setImage(self, image):
+        # numpy 配列を参照している QImage が渡されるので、呼び出し元のスレッドで複製して所有する
+        # 一括処理では AutoMarker のスレッドから呼ばれるため、差し替えは描画と同じ GUI スレッドで行う
+        self.imageChanged.emit(None if image is None else image.copy())
+
+    def replaceImage(self, image):
         self.image = image
+        self.pyramid = [] if image is None else [image]
+        self.cache = None
+        self.cache_key = None
         self.update()
 
     def setRatio(self, ratio):
@@ -49,16 +75,93 @@ class ImageWidget(QtWidgets.QWidget):
     def getRatio(self, ratio):
         return self.ratio
 
+    def fitRatio(self):
+        return min(self.width() / self.image.width(), self.height() / self.image.height())
+
+    def maxZoom(self):
+        # 原寸 (1 画素 = 1 デバイス画素) より大きくはしない
+        return max(1.0, 1.0 / (self.fitRatio() * self.devicePixelRatioF()))
+
+    def level(self, width):
+        """width 以上の大きさを持つ最小のミップマップを返す"""
+        while True:
+            image = self.pyramid[-1]
+            if image.width() // 2 < max(width, self.PYRAMID_MIN_WIDTH):
+                break
+            self.pyramid.append(image.scaled(
+                image.width() // 2,
+                image.height() // 2,
+                QtCore.Qt.IgnoreAspectRatio,
+                QtCore.Qt.SmoothTransformation))
+
+        for image in reversed(self.pyramid):
+            if image.width() >= width:
+                return image
+        return self.pyramid[0]
+
+    def pixmap(self):
+        dpr = self.devicePixelRatioF()
+        key = (self.width(), self.height(), dpr, self.zoom)
+
+        # 表示サイズに合わせて縮小したものをキャッシュし、再描画では使い回す
+        if self.cache_key != key:
+            width = max(1, round(self.image.width() * self.ratio * dpr))
+            height = max(1, round(self.image.height() * self.ratio * dpr))
+            self.cache = QtGui.QPixmap.fromImage(self.level(width).scaled(
+                width,
+                height,
+                QtCore.Qt.IgnoreAspectRatio,
+                QtCore.Qt.SmoothTransformation))
+            self.cache.setDevicePixelRatio(dpr)
+            self.cache_key = key
+
+        return self.cache
+
+    def clampOffset(self):
+        # 画像が表示領域より小さい方向は左上寄せ、大きい方向ははみ出さない範囲で移動
+        x = min(0, max(self.width() - self.image.width() * self.ratio, self.offset.x()))
+        y = min(0, max(self.height() - self.image.height() * self.ratio, self.offset.y()))
+        self.offset = QtCore.QPoint(int(x), int(y))
+
+    def setZoom(self, zoom, anchor=None):
+        if self.image is None:
+            return
+
+        if anchor is None:
+            anchor = QtCore.QPoint(0, 0)
+
+        # anchor 位置の画素が動かないようにずらす
+        before = self.ratio
+        self.zoom = min(max(zoom, 1.0), self.maxZoom())
+        self.ratio = self.fitRatio() * self.zoom
+        self.offset = anchor - (anchor - self.offset) * (self.ratio / before)
+        self.clampOffset()
+        self.update()
+
     def mousePressEvent(self, event):
+        if event.button() == QtCore.Qt.LeftButton:
+            self.drag = event.pos() - self.offset
         super(ImageWidget, self).mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
+        if self.drag is not None and self.image is not None:
+            self.offset = event.pos() - self.drag
+            self.clampOffset()
+            self.update()
         super(ImageWidget, self).mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
+        self.drag = None
         super(ImageWidget, self).mouseReleaseEvent(event)
 
+    def mouseDoubleClickEvent(self, event):
+        self.setZoom(1.0)
+        super(ImageWidget, self).mouseDoubleClickEvent(event)
+
     def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.setZoom(self.zoom * self.ZOOM_STEP ** steps, event.pos())
         super(ImageWidget, self).wheelEvent(event)
 
     def paintEvent(self, event):
@@ -66,29 +169,201 @@ class ImageWidget(QtWidgets.QWidget):
         if self.image is None:
             return
 
+        self.zoom = min(self.zoom, self.maxZoom())
+        self.ratio = self.fitRatio() * self.zoom
+        self.clampOffset()
+
         painter = QtGui.QPainter(self)
-        # painter.begin(self)
+        painter.drawPixmap(self.offset, self.pixmap())
+        painter.end()
 
-        painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
-        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, True)
 
-        itemAspectRatio  = self.image.width() / self.image.height()
-        sceneAspectRatio = self.width() / self.height()
+class ThumbnailCache(object):
+    """ファイル内容のハッシュをキーにしたサムネイルのディスクキャッシュ (LRU)"""
+    WIDTH = 160
+    # 上限を超えたら古く使われたものから消す
+    LIMIT = 200 * 1024 * 1024
 
-        if itemAspectRatio >= sceneAspectRatio:
-            self.ratio = self.width() / self.image.width()
-        else:
-            self.ratio = self.height() / self.image.height()
+    def __init__(self, path=None):
+        self.path = path or Path.home() / ".cache" / "marksheet-reader" / "thumbnails"
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.mutex = QtCore.QMutex()
+        self.size = sum(p.stat().st_size for p in self.path.glob("*.png"))
+
+    def get(self, key):
+        p = self.path / (key + ".png")
+
+        # 最終利用時刻として更新時刻を使う (他のスレッドが消していたら作り直す)
+        try:
+            os.utime(str(p))
+        except OSError:
+            return None
+        return cv2.imread(str(p))
+
+    def put(self, key, image):
+        p = self.path / (key + ".png")
+        ok, buf = cv2.imencode(".png", image)
+        if not ok:
+            return
 
-        painter.scale(self.ratio, self.ratio)
+        # 同じシートを同時に書いても混ざらないよう、一時ファイルはスレッドごとに作る
+        fd, tmp = tempfile.mkstemp(dir=str(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf.tobytes())
+            os.replace(tmp, str(p))
+        except OSError:
+            os.unlink(tmp)
+            raise
 
-        # Scale値依存
-        # painter.translate(0, 0)
-        painter.drawImage(0, 0, self.image)
+        with QtCore.QMutexLocker(self.mutex):
+            self.size += p.stat().st_size
+            if self.size > self.LIMIT:
+                self.evict()
 
-        painter.end()
+    def evict(self):
+        files = sorted(self.path.glob("*.png"), key=lambda p: p.stat().st_mtime)
+        self.size = sum(p.stat().st_size for p in files)
+        for p in files:
+            if self.size <= self.LIMIT * 0.8:
+                break
+            self.size -= p.stat().st_size
+            p.unlink()
+
+
+class ThumbnailSignals(QtCore.QObject):
+    # (ファイルのフルパス, サムネイル)、作れなかったときは空の QImage
+    finished = QtCore.pyqtSignal(str, QtGui.QImage)
 
 
+class ThumbnailTask(QtCore.QRunnable):
+    def __init__(self, path, cache, signals):
+        super(ThumbnailTask, self).__init__()
+        self.path = path
+        self.cache = cache
+        self.signals = signals
+
+    def run(self):
+        try:
+            image = self.load()
+        except (OSError, cv2.error):
+            image = None
+
+        # 失敗しても知らせないと、一覧側がいつまでも待ち状態のままになる
+        if image is None:
+            self.signals.finished.emit(str(self.path), QtGui.QImage())
+            return
+
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        h, w, c = image.shape
+        qimage = QtGui.QImage(image.data, w, h, (c * w), QtGui.QImage.Format_RGB888).copy()
+        self.signals.finished.emit(str(self.path), qimage)
+
+    def load(self):
+        data = self.path.read_bytes()
+
+        key = hashlib.sha1(data).hexdigest()
+        image = self.cache.get(key)
+        if image is None:
+            # JPEG は縮小しながらデコードできるので原寸では読まない
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+            if image is None:
+                return None
+            h, w, c = image.shape
+            width = ThumbnailCache.WIDTH
+            image = cv2.resize(image, (width, max(1, h * width // w)), interpolation=cv2.INTER_AREA)
+
+            # キャッシュに書けなくてもサムネイルは出す
+            try:
+                self.cache.put(key, image)
+            except OSError:
+                pass
+        return image
+
+
+class SheetListModel(QtCore.QAbstractListModel):
+    """シート一覧 (サムネイルは表示されたものだけ裏で作る)"""
+    # メモリ上に置いておくサムネイルの数
+    PIXMAP_LIMIT = 1000
+
+    def __init__(self, parent=None):
+        super(SheetListModel, self).__init__(parent=parent)
+        self.cache = ThumbnailCache()
+        # QImage.scaled が共有プールで縮小を分担して待つので、GIL を取り合うこちらは別のプールで動かす
+        self.pool = QtCore.QThreadPool(self)
+        self.signals = ThumbnailSignals()
+        self.signals.finished.connect(self.setThumbnail)
+        self.setSheets(None, [])
+
+    def setSheets(self, directory, names):
+        self.pool.clear()
+        self.beginResetModel()
+        self.directory = directory
+        self.names = names
+        self.rows = {name: i for i, name in enumerate(names)}
+        self.results = {}
+        self.pixmaps = OrderedDict()
+        self.pending = set()
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        name = self.names[index.row()]
+        result = self.results.get(name)
+
+        if role == QtCore.Qt.DisplayRole:
+            if result is None:
+                return name
+            return "{}\n{}  {}点".format(name, result[0], result[1])
+        if role == QtCore.Qt.ToolTipRole and result is not None and result[2]:
+            return result[2]
+        if role == QtCore.Qt.ForegroundRole and result is not None and result[2]:
+            return QtGui.QBrush(QtGui.QColor(200, 0, 0))
+        if role == QtCore.Qt.DecorationRole:
+            return self.thumbnail(name)
+        return None
+
+    def thumbnail(self, name):
+        if name in self.pixmaps:
+            self.pixmaps.move_to_end(name)
+            return self.pixmaps[name]
+
+        # 表示されたときに初めて作る
+        if name not in self.pending:
+            self.pending.add(name)
+            self.pool.start(ThumbnailTask(self.directory / name, self.cache, self.signals))
+        return None
+
+    def setThumbnail(self, path, image):
+        # 前に開いていたディレクトリの結果は捨てる
+        path = Path(path)
+        if self.directory is None or path.parent != self.directory or path.name not in self.rows:
+            return
+
+        name = path.name
+        self.pending.discard(name)
+
+        # 作れなかったシートは None を置いて何度も作り直さないようにする
+        self.pixmaps[name] = None if image.isNull() else QtGui.QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.PIXMAP_LIMIT:
+            self.pixmaps.popitem(last=False)
+
+        index = self.index(self.rows[name])
+        self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+
+    def setResult(self, name, number, score, flags=""):
+        if name not in self.rows:
+            return
+
+        self.results[name] = (number, score, flags)
+        index = self.index(self.rows[name])
+        self.dataChanged.emit(index, index)
+
 
 class Utils(object):
     @classmethod
@@ -117,6 +392,13 @@ class Utils(object):
 
         return result
 
+    @classmethod
+    def overlay(cls, base, answer, color):
+        # マーク部分だけ色を置き換える (画素ごとの添字参照ではなくマスク付き演算で行う)
+        result = cv2.bitwise_and(base, base, mask=255 - answer)
+        cv2.add(result, color, dst=result, mask=answer)
+        return result
+
 
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, parent=None):
@@ -129,13 +411,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def threadUpdate(self, score):
         self.result.append(score)
+        self.sheet_model.setResult(self.current, score[0], score[1])
 
-        if self.ui.comboBox.currentIndex() + 1 == self.ui.comboBox.count():
+        if self.currentRow() + 1 == self.sheet_model.rowCount():
             self.thread.terminate()
 
             self.threadFinish()
         else:
-            self.ui.comboBox.setCurrentIndex(self.ui.comboBox.currentIndex() + 1)
+            self.setCurrentRow(self.currentRow() + 1)
 
     def threadFinish(self):
         self.ui.batch_button.setText("一括処理")
@@ -178,20 +461,64 @@ class MainWindow(QtWidgets.QMainWindow):
         layout = QtWidgets.QVBoxLayout(self.ui.output_widget)
         layout.addWidget(self.output_viewer)
 
+        # シート一覧 (表示されている分だけサムネイルを作る)
+        self.sheet_model = SheetListModel(self)
+        self.sheet_view = QtWidgets.QListView(self)
+        self.sheet_view.setModel(self.sheet_model)
+        self.sheet_view.setUniformItemSizes(True)
+        self.sheet_view.setLayoutMode(QtWidgets.QListView.Batched)
+        self.sheet_view.setIconSize(QtCore.QSize(ThumbnailCache.WIDTH, ThumbnailCache.WIDTH * 3 // 4))
+        self.sheet_view.selectionModel().currentChanged.connect(self.selectSheet)
+        self.sheet_view.activated.connect(self.openSheet)
+
+        dock = QtWidgets.QDockWidget("シート一覧", self)
+        dock.setWidget(self.sheet_view)
+        self.addDockWidget(QtCore.Qt.LeftDockWidgetArea, dock)
+
+        # 大量のファイルを入れられないコンボボックスの代わりに選択中のシート名を出す
+        self.ui.comboBox.hide()
+        self.current_label = QtWidgets.QLabel(self)
+        self.ui.gridLayout.addWidget(self.current_label, 1, 1, 1, 4)
+
+        # 閾値のライブプレビュー (スライダー操作が落ち着いてから再計算する)
+        self.live_check = QtWidgets.QCheckBox("ライブプレビュー", self)
+        self.live_check.toggled.connect(self.livePreview)
+        self.ui.horizontalLayout_4.insertWidget(0, self.live_check)
+
+        self.live_timer = QtCore.QTimer(self)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.setInterval(100)
+        self.live_timer.timeout.connect(self.livePreview)
+        self.ui.spinBox.valueChanged.connect(self.scheduleLivePreview)
+
     def setupColor(self):
         self.POSITION_MARKER = (255, 0, 0)
         self.POSITION_MARKER_LINE = (0, 0, 255)
         self.ANSWER_MARKER = (0, 255, 0)
 
     def reset(self):
+        self.current = ""
         self.input_viewer.setImage(None)
         self.output_viewer.setImage(None)
         self.markers_x = None
         self.markers_y = None
         self.answer = None
+        self.answer_key = None
+        self.number = ""
+        self.gray = None
+        self.gray_path = None
+        self.live_base = None
+        self.live_preview = None
         self.ui.number_lcd.display("")
         self.ui.score_lcd.display("")
 
+    def clearMarkers(self):
+        # 別のシートのマーカー位置でプレビューしないよう捨てておく
+        self.markers_x = None
+        self.markers_y = None
+        self.live_base = None
+        self.live_preview = None
+
     def batchMark(self):
         self.thread.setFunc(self.autoFunctions)
         self.thread.update.connect(self.threadUpdate)
@@ -246,8 +573,35 @@ class MainWindow(QtWidgets.QMainWindow):
         if dirname:
             self.ui.input_path.setText(dirname)
 
-            for p in Path(dirname).glob("*.jpg"):
-                self.ui.comboBox.addItem(p.name)
+            names = sorted(p.name for p in Path(dirname).glob("*.jpg"))
+            self.sheet_model.setSheets(Path(dirname), names)
+            if names:
+                self.setCurrentRow(0)
+
+    def currentRow(self):
+        return self.sheet_view.currentIndex().row()
+
+    def setCurrentRow(self, row):
+        self.sheet_view.setCurrentIndex(self.sheet_model.index(row))
+
+    def selectSheet(self, current, previous):
+        self.current = self.sheet_model.names[current.row()] if current.isValid() else ""
+        self.current_label.setText(self.current)
+
+        # 一括処理中は AutoMarker が次のシートのマーカーを検出済みのことがあるので消さない
+        if not self.thread.isRunning():
+            self.clearMarkers()
+
+    def openSheet(self, index):
+        # 詳しく見るシートだけ原寸で読み込む
+        if self.thread.isRunning():
+            return
+
+        if self.getMarkerPosition() is False:
+            self.sheet_model.setResult(self.current, "-", "-", "マーカー未検出")
+            return
+        self.getMarker()
+        self.getScore()
 
 
     def getOutputDir(self):
@@ -265,12 +619,26 @@ class MainWindow(QtWidgets.QMainWindow):
                 "マーカーの数が不足しています。\n期待値：{}\n検出数：{}".format(count, len(markers)))
             return False
 
+    def loadGray(self, path):
+        # 閾値を変えるたびに読み直さないよう、グレースケール画像を保持しておく
+        if self.gray_path != path:
+            self.gray = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+            self.gray_path = path
+        return self.gray
+
+    def loadAnswerKey(self):
+        if self.answer_key is None:
+            f = csv.reader(open("answer.csv"))
+            header = next(f)
+            self.answer_key = np.array([[1 if r == "x" else 0 for r in row[1:]] for row in f])
+        return self.answer_key
+
     def getMarkerPosition(self):
-        if not self.ui.comboBox.currentText():
+        if not self.current:
             return
 
-        path = Path(self.ui.input_path.text()) / Path(self.ui.comboBox.currentText())
-        target = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+        path = Path(self.ui.input_path.text()) / Path(self.current)
+        target = self.loadGray(path)
         h, w = target.shape
         height = int(h * 0.02)
         width = int(w * 0.02)
@@ -278,9 +646,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.markers_x = Utils.getMarkerPosition(target[h - height:int(h - height / 10), 0:w], 0)
         self.markers_y = Utils.getMarkerPosition(target[0:h, w - width:int(w - width / 10)], 1)
 
-        if not self.assertMarkerCount(47, self.markers_x):
-            return False
-        if not self.assertMarkerCount(25, self.markers_y):
+        if not self.assertMarkerCount(47, self.markers_x) or not self.assertMarkerCount(25, self.markers_y):
+            self.clearMarkers()
             return False
 
         self.marker_position_preview = cv2.imread(str(path))
@@ -305,17 +672,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.input_viewer.setImage(qimage)
 
     def getMarker(self):
-        if not self.ui.comboBox.currentText():
+        if not self.current:
             return
 
-        path = Path(self.ui.input_path.text()) / Path(self.ui.comboBox.currentText())
+        path = Path(self.ui.input_path.text()) / Path(self.current)
         value = self.ui.spinBox.value()
-        target = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
-        res, target = cv2.threshold(target, value, 255, cv2.THRESH_BINARY)
-        self.answer = 255 - target
+        target = self.loadGray(path)
+        res, self.answer = cv2.threshold(target, value, 255, cv2.THRESH_BINARY_INV)
 
-        self.marker_preview = self.marker_position_preview.copy()
-        self.marker_preview[np.where(self.answer == 255)] = self.ANSWER_MARKER
+        self.marker_preview = Utils.overlay(self.marker_position_preview, self.answer, self.ANSWER_MARKER)
         h, w, c = self.marker_preview.shape
 
         qimage = QtGui.QImage(
@@ -327,6 +692,65 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.input_viewer.setImage(qimage)
 
+    def scheduleLivePreview(self):
+        if self.live_check.isChecked():
+            self.live_timer.start()
+
+    def livePreview(self):
+        _ = [
+            not self.live_check.isChecked(),
+            self.thread.isRunning(),
+            self.gray is None,
+            self.markers_x is None or len(self.markers_x) != 47,
+            self.markers_y is None or len(self.markers_y) != 25,
+        ]
+        if any(_):
+            return
+
+        value = self.ui.spinBox.value()
+        h, w = self.gray.shape
+        xs = np.array([x[0] for x in self.markers_x])
+        ys = np.array([y[1] for y in self.markers_y])
+
+        # マーク欄を囲む範囲だけを二値化・着色し直す
+        radius = int(w * 0.01)
+        region = (
+            slice(max(0, ys.min() - radius), min(h, ys.max() + radius)),
+            slice(max(0, xs.min() - radius), min(w, xs.max() + radius)))
+
+        if self.answer is None or self.answer.shape != self.gray.shape:
+            self.answer = np.zeros_like(self.gray)
+        if self.live_base is not self.marker_position_preview:
+            self.live_base = self.marker_position_preview
+            self.live_preview = self.marker_position_preview.copy()
+
+        res, self.answer[region] = cv2.threshold(self.gray[region], value, 255, cv2.THRESH_BINARY_INV)
+        self.live_preview[region] = Utils.overlay(
+            self.marker_position_preview[region], self.answer[region], self.ANSWER_MARKER)
+
+        h, w, c = self.live_preview.shape
+        qimage = QtGui.QImage(
+            self.live_preview.data,
+            w,
+            h,
+            (c * w),
+            QtGui.QImage.Format_RGB888)
+        self.input_viewer.setImage(qimage)
+
+        # 交点の画素だけを見て学籍番号と点数を出す
+        marked = self.gray[np.ix_(ys, xs)] <= value
+
+        number = ""
+        for column in marked[:10, :7].T:
+            if column.any():
+                number += str(column.argmax())
+        self.ui.number_lcd.display(number)
+
+        rows = len(ys)
+        question = marked[:, 7:].reshape(rows, -1, 10).transpose(1, 0, 2).reshape(-1, 10)
+        key = self.loadAnswerKey()
+        self.ui.score_lcd.display(str(int((question[:len(key)] == key).all(axis=1).sum())))
+
     def getScore(self):
         _ = [
             self.markers_x is None,
@@ -343,7 +767,7 @@ class MainWindow(QtWidgets.QMainWindow):
             "answer_y": self.markers_y,
         }
 
-        path = Path(self.ui.input_path.text()) / Path(self.ui.comboBox.currentText())
+        path = Path(self.ui.input_path.text()) / Path(self.current)
         self.answer_preview = cv2.imread(str(path))
         h, w, c = self.answer_preview.shape
 
@@ -368,6 +792,8 @@ class MainWindow(QtWidgets.QMainWindow):
                     break
         else:
             self.ui.number_lcd.display(result)
+        # LCD の値は数値なので先頭の 0 が落ちる、一覧には読み取った文字列を出す
+        self.number = result
 
         # 各問題の処理
         result = []
@@ -404,14 +830,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.output_viewer.setImage(qimage)
 
         # 採点処理
-        f = csv.reader(open("answer.csv"))
-        header = next(f)
-
         score = 0
-        for i, row in enumerate(f):
+        for i, row in enumerate(self.loadAnswerKey()):
             # print(i+1, "問目", end="")
             
-            if [ 1 if r == "x" else 0 for r in row[1:]] == result[i]:
+            if row.tolist() == result[i]:
                 # print("正解")
                 score += 1
             else:
@@ -420,6 +843,10 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.ui.score_lcd.display(str(score))
 
+        # 一括処理中は threadUpdate で反映する
+        if not self.thread.isRunning():
+            self.sheet_model.setResult(self.current, self.number, score)
+
     def outputFile(self, silent=False):
         if not self.ui.output_path.text():
             QtWidgets.QMessageBox.warning(
@@ -427,7 +854,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 "出力先未定義",
                 "出力先が未設定です。")
             return
-        if not self.ui.comboBox.currentText():
+        if not self.current:
             return
         if self.answer_preview is None:
             return
@@ -435,7 +862,7 @@ class MainWindow(QtWidgets.QMainWindow):
         path = Path(self.ui.output_path.text()) / Path(
             str(int(self.ui.number_lcd.value()))
             + "_" + str(int(self.ui.score_lcd.value())) + "_"
-            + str(Path(self.ui.comboBox.currentText())))
+            + str(Path(self.current)))
         cv2.imwrite(str(path), self.answer_preview)
 
         if silent:
@@ -446,7 +873,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 "出力終了",
                 "出力が完了しました")
         return [
-            str(int(self.ui.number_lcd.value())),
+            self.number,
             int(self.ui.score_lcd.value())
         ]
 
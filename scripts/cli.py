@@ -1,10 +1,50 @@
 import argparse
+import contextlib
 import csv
-from pathlib import Path
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import sys
+import tarfile
+import time
+import zipfile
+from pathlib import Path, PurePosixPath
 
-import cv2
-import numpy as np
-from PIL import Image
+# cv2 / numpy / PIL は読み込みが重いので最初に使うときまで遅延させる
+cv2 = None
+np = None
+Image = None
+
+
+def load_modules():
+    global cv2, np, Image
+
+    if cv2 is None:
+        import cv2
+        import numpy as np
+        from PIL import Image
+
+
+ARCHIVE_SUFFIXES = {
+    ".zip": None,
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tar.xz": "w:xz",
+}
+
+
+def archive_suffix(path) -> str:
+    name = str(path).lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return ""
 
 
 def open_dir(path):
@@ -19,57 +59,345 @@ def open_dir(path):
     return p
 
 
+def parse_budget(text):
+    stage, _, ms = text.partition("=")
+
+    if stage not in STAGES:
+        raise argparse.ArgumentTypeError("unknown stage : {} ({})".format(stage, ", ".join(STAGES)))
+
+    try:
+        return stage, float(ms)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid budget : {}".format(text))
+
+
+def open_input(path):
+    # "-" は標準入力 (tar / zip ストリーム)
+    if path == "-":
+        return path
+
+    p = Path(path)
+
+    if not p.exists():
+        raise argparse.ArgumentTypeError("not exists : {}".format(p))
+
+    if not (p.is_dir() or archive_suffix(p)):
+        raise argparse.ArgumentTypeError("not dir or archive : {}".format(p))
+
+    return p
+
+
+def open_output(path):
+    # "-" は標準出力 (tar ストリーム)
+    if path == "-":
+        return path
+
+    p = Path(path)
+
+    if archive_suffix(p):
+        if not p.parent.is_dir():
+            raise argparse.ArgumentTypeError("not exists : {}".format(p.parent))
+        return p
+
+    return open_dir(path)
+
+
+def read_sheets(source, ext: list):
+    """入力元から (パス, バイト列) の組を順に返す"""
+    if source == "-":
+        yield from read_stream(sys.stdin.buffer, ext)
+    elif source.is_dir():
+        for e in ext:
+            for p in source.glob("*." + e):
+                yield p, p.read_bytes()
+    elif archive_suffix(source) == ".zip":
+        with zipfile.ZipFile(str(source)) as archive:
+            yield from read_zip(archive, ext)
+    else:
+        with tarfile.open(str(source), "r:*") as archive:
+            yield from read_tar(archive, ext)
+
+
+def sheet_key(source, path) -> str:
+    """結果の保存や突き合わせに使う、実行場所によらないシートの名前"""
+    if source == "-":
+        return "-:{}".format(path)
+    if source.is_dir():
+        return str(Path(path).resolve())
+    return "{}:{}".format(source.resolve(), path)
+
+
+def sheet_name(source, path) -> str:
+    """出力先に書き出すときの名前 (アーカイブ内のフォルダ構成は残す)"""
+    if source != "-" and source.is_dir():
+        return path.name
+
+    # 出力先のディレクトリの外に書かないよう、絶対パスや .. は取り除く
+    return "/".join(part for part in PurePosixPath(path).parts if part not in ("/", ".", ".."))
+
+
+def read_stream(stream, ext: list):
+    # zip は末尾に目録があるので全体をメモリに読む、tar はそのまま逐次読む
+    if stream.peek(4)[:4] == b"PK\x03\x04":
+        with zipfile.ZipFile(io.BytesIO(stream.read())) as archive:
+            yield from read_zip(archive, ext)
+    else:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            yield from read_tar(archive, ext)
+
+
+def read_zip(archive: zipfile.ZipFile, ext: list):
+    for info in archive.infolist():
+        path = PurePosixPath(info.filename)
+        if not info.is_dir() and path.suffix[1:].lower() in ext:
+            yield path, archive.read(info)
+
+
+def read_tar(archive: tarfile.TarFile, ext: list):
+    for member in archive:
+        path = PurePosixPath(member.name)
+        if member.isfile() and path.suffix[1:].lower() in ext:
+            yield path, archive.extractfile(member).read()
+
+
+def decode_image(data: bytes, flags: int) -> "np.ndarray":
+    """メモリ上のバイト列から画像を復元する (カラーは RGB で返す、読めなければ OSError)"""
+    try:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    except cv2.error:
+        image = None
+
+    if image is None:
+        # OpenCV が読めない形式 (GIF など) は PIL で読む
+        mode = "L" if flags == cv2.IMREAD_GRAYSCALE else "RGB"
+        try:
+            return np.array(Image.open(io.BytesIO(data)).convert(mode))
+        except (OSError, Image.DecompressionBombError) as e:
+            raise OSError("cannot decode image: {}".format(e))
+
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image
+
+
+def encode_image(image: "np.ndarray", suffix: str) -> bytes:
+    try:
+        ok, buf = cv2.imencode(suffix, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    except cv2.error:
+        ok = False
+
+    if ok:
+        return buf.tobytes()
+
+    # OpenCV が書けない形式は PIL で書く
+    f = io.BytesIO()
+    Image.fromarray(image).save(f, format=Image.registered_extensions()[suffix.lower()])
+    return f.getvalue()
+
+
+class SheetWriter(object):
+    """出力画像をディレクトリ・アーカイブ・標準出力 (tar) に書き出す"""
+
+    def __init__(self, target):
+        self.target = target
+        self.archive = None
+
+        if target == "-":
+            self.archive = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+        elif archive_suffix(target) == ".zip":
+            self.archive = zipfile.ZipFile(str(target), "w")
+        elif archive_suffix(target):
+            self.archive = tarfile.open(str(target), ARCHIVE_SUFFIXES[archive_suffix(target)])
+
+    def write(self, name: str, data: bytes):
+        if self.archive is None:
+            p = self.target / name
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_bytes(data)
+        elif isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+        if self.target == "-":
+            sys.stdout.buffer.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class MarkSheetResult(object):
     def __init__(self, **kargs):
         self.path = kargs.get("path")
+        self.key = kargs.get("key")
+        self.name = kargs.get("name")
+        self.data = kargs.get("data")
+        self.digest = kargs.get("digest")
         self.number = kargs.get("number")
         self.question = kargs.get("question")
         self.score = kargs.get("score")
         self.x = kargs.get("x")
         self.y = kargs.get("y")
         self.image = kargs.get("image")
+        self.flag = kargs.get("flag", "")
+        self.timings = kargs.get("timings", {})
+        self.rotated = kargs.get("rotated", False)
+        # 学籍番号が同じでマークが異なる、先に取り込んだシート
+        self.conflict = kargs.get("conflict")
 
     def __str__(self):
-        return "{} student: {} score: {}".format(self.__class__.__name__, self.number, self.score)
+        text = "{} student: {} score: {}".format(self.__class__.__name__, self.number, self.score)
+        if self.flag:
+            text += " flag: {}".format(self.flag)
+        return text
 
 
 class MarkSheetParser(object):
-    def __init__(self, path: Path, thresh: int):
-        self.path = path
+    # 事前判定に使う縮小画像の幅
+    THUMBNAIL_WIDTH = 800
+    # マーカー探索で帯をずらす幅
+    PADDING = 10
+    # 時間切れ時のマーカー探索に使う縮小率
+    COARSE_SCALE = 4
+    # 事前判定でマーカーを探す端からの範囲 (画像の大きさに対する割合)
+    MARKER_BAND = 0.15
+
+    def __init__(self, data: bytes, thresh: int):
+        load_modules()
         self.thresh = thresh
-        self.color_image = np.array(Image.open(self.path.open("rb")).convert("L"))
+        self.rotated = False
+        self.coarse = False
+        self.markers_x = None
+        self.markers_y = None
+        self.color_image = decode_image(data, cv2.IMREAD_GRAYSCALE)
+        self.binarize()
+
+    def binarize(self):
         _, self.image = cv2.threshold(self.color_image, self.thresh, 255, cv2.THRESH_BINARY)
         self.image = 255 - self.image
         self.h, self.w = self.image.shape
 
-    def trackPoisiton(self) -> (list, list):
-        width = int(self.w * 0.03)
-        height = int(self.h * 0.03)
+    def classify(self) -> str:
+        """縮小画像で白紙・マーカーなしを判定して理由を返す (問題なければ空文字)
 
-        padding = 10
-        for w in range(self.w // padding):
-            start_h = self.h - padding * (w + 1)
-            end_h = self.h - padding * w
+        上下逆に読み込まれたシートはここで 180 度回転する
+        """
+        # 整数倍で縮小する方が INTER_AREA は速い
+        scale = 1 / max(1, self.color_image.shape[1] // self.THUMBNAIL_WIDTH)
+        thumbnail = cv2.resize(self.color_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # 二値化と同じ閾値で黒い画素を拾う
+        ink = thumbnail < self.thresh
 
-            markers_x = self.__trackPosition(self.image[start_h:end_h, 0:self.w], 0)
-            if len(markers_x) == 47:
-                break
-        else:
-            raise IndexError("cant find width marker")
+        coverage = ink.mean()
+        if coverage < 0.002:
+            return "blank"
+        if coverage > 0.5:
+            return "dark"
 
-        for h in range(self.h // padding):
-            start_w = self.w - padding * (h + 1)
-            end_w = self.w - padding * h
+        # 下端側に横方向のマーカー 47 個、右端側に縦方向のマーカー 25 個が並ぶ
+        # (印刷・スキャンの余白があるので端からある程度内側まで探す)
+        th, tw = ink.shape
+        band_h = max(1, int(th * self.MARKER_BAND))
+        band_w = max(1, int(tw * self.MARKER_BAND))
 
-            markers_y = self.__trackPosition(self.image[0:self.h, start_w:end_w], 1)
-            if len(markers_y) == 25:
-                break
-        else:
+        if self.hasMarkers(ink[:th - band_h - 1:-1, :], 47) and self.hasMarkers(ink[:, :tw - band_w - 1:-1].T, 25):
+            return ""
+
+        if self.hasMarkers(ink[:band_h, :], 47) and self.hasMarkers(ink[:, :band_w].T, 25):
+            self.color_image = cv2.rotate(self.color_image, cv2.ROTATE_180)
+            self.rotated = True
+            self.binarize()
+            return ""
+
+        return "no-marker"
+
+    @staticmethod
+    def hasMarkers(band: "np.ndarray", count: int) -> bool:
+        """端から内側へ並べた帯の行のうち、最も外側の印刷のある行に黒い区間がおよそ count 個並んでいるか"""
+        runs = band[:, 0].astype(int) + np.count_nonzero(band[:, 1:] & ~band[:, :-1], axis=1)
+
+        # ゴミや罫線のような区間の少ない行は飛ばす (内側のマーク欄の行で誤判定しないよう外側の1行だけを見る)
+        rows = np.flatnonzero(runs >= count * 0.3)
+        return rows.size > 0 and count * 0.8 <= runs[rows[0]] <= count * 1.2
+
+    def trackPoisiton(self, deadline: float = None) -> (list, list):
+        """位置マーカーを探す
+
+        deadline (time.perf_counter() の値) を過ぎたら縮小画像で大まかな位置を探し、
+        その周辺だけを原寸で探し直す
+        """
+        self.coarse = False
+        self.markers_x = None
+        self.markers_y = None
+
+        self.markers_x = self.__searchMarkers(0, 47, deadline)
+        if self.markers_x is None:
+            raise IndexError("cant find width marker")
+
+        self.markers_y = self.__searchMarkers(1, 25, deadline)
+        if self.markers_y is None:
             raise IndexError("cant find height marker")
 
-        return markers_x, markers_y
+        return self.markers_x, self.markers_y
 
-    def __trackPosition(self, image: np.ndarray, axis: int) -> list:
+    def __searchMarkers(self, axis: int, count: int, deadline: float) -> list:
+        strips = self.image.shape[axis] // self.PADDING
+        markers, index = self.__scanStrips(self.image, axis, count, range(strips), deadline)
+        if index != -1:
+            return markers
+
+        # 時間切れ: 縮小画像 (画素数 1/16、帯の数 1/4) で大まかな位置を探す
+        self.coarse = True
+        scale = self.COARSE_SCALE
+        small = cv2.resize(self.image, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA)
+        _, small = cv2.threshold(small, 127, 255, cv2.THRESH_BINARY)
+
+        strips = small.shape[axis] // self.PADDING
+        markers, index = self.__scanStrips(small, axis, count, range(strips), None)
+        if markers is None:
+            return None
+
+        # 見つかった帯の周辺だけを原寸で探し直す
+        around = range(max(0, (index - 1) * scale), (index + 2) * scale)
+        fine, _ = self.__scanStrips(self.image, axis, count, around, None)
+        if fine is not None:
+            return fine
+
+        # 原寸で揃わなければ縮小画像での位置をそのまま使う
+        return [(x * scale, y * scale) for x, y in markers]
+
+    def __scanStrips(self, image: "np.ndarray", axis: int, count: int, indices, deadline: float) -> (list, int):
+        """端から帯をずらしてマーカーを探し、(マーカー, 帯の番号) を返す (時間切れなら番号は -1)"""
+        h, w = image.shape
+        padding = self.PADDING
+
+        for i in indices:
+            if deadline is not None and time.perf_counter() > deadline:
+                return None, -1
+
+            # 横マーカーは下端から、縦マーカーは右端から探す
+            if axis == 0:
+                strip = image[h - padding * (i + 1):h - padding * i, 0:w]
+            else:
+                strip = image[0:h, w - padding * (i + 1):w - padding * i]
+
+            markers = self.__trackPosition(strip, axis)
+            if len(markers) == count:
+                return markers, i
+
+        return None, None
+
+    def __trackPosition(self, image: "np.ndarray", axis: int) -> list:
         # マーカー検出
         image, contours, hierarchy = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         # マーカー重心位置取得
@@ -116,23 +444,448 @@ class MarkSheetParser(object):
             return np.asarray(result)
 
 
+def add_flag(flag: str, *more: str) -> str:
+    """";" 区切りの印に追加する"""
+    return ";".join(filter(None, (flag,) + more))
+
+
+class SheetIndex(object):
+    """取り込み済みシートの索引 (再給紙による重複スキャンの検出用)"""
+
+    # 学籍番号の桁数
+    NUMBER_DIGITS = 7
+
+    def __init__(self):
+        # 内容ハッシュ -> パス
+        self.contents = {}
+        # マーク読み取り結果のハッシュ -> パス
+        self.answers = {}
+        # 学籍番号 -> パス
+        self.numbers = {}
+
+    @staticmethod
+    def contentDigest(data: bytes) -> str:
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def answerDigest(number: str, question: "np.ndarray") -> str:
+        return hashlib.sha1(number.encode() + np.packbits(question.astype(bool)).tobytes()).hexdigest()
+
+    def findContent(self, digest: str, path):
+        """同一ファイルを取り込み済みならそのパスを返す"""
+        other = self.contents.get(digest)
+        if other is None:
+            self.contents[digest] = path
+        return other
+
+    @classmethod
+    def completeNumber(cls, number: str) -> bool:
+        return number is not None and len(number) == cls.NUMBER_DIGITS
+
+    def findAnswer(self, number: str, question: "np.ndarray", path) -> (object, object):
+        """(同じマークのシート, 同じ学籍番号でマークが異なるシート) を返す"""
+        # 学籍番号が読み切れないシート同士は別人でも一致しうるので突き合わせない
+        if not self.completeNumber(number):
+            return None, None
+
+        digest = self.answerDigest(number, question)
+        other = self.answers.get(digest)
+        if other is not None:
+            return other, None
+
+        self.answers[digest] = path
+        conflict = self.numbers.get(number)
+        if conflict is None:
+            self.numbers[number] = path
+        return None, conflict
+
+
+class AnswerMatrix(object):
+    """読み取ったマークを (シート数, 問題数, 選択肢数) のビット列として蓄積する"""
+
+    def __init__(self, questions: int = 100, choices: int = 10, capacity: int = 1024):
+        load_modules()
+        self.choices = choices
+        self.count = 0
+        self.packed = np.zeros((capacity, questions, (choices + 7) // 8), dtype=np.uint8)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, question: "np.ndarray"):
+        if self.count == self.packed.shape[0]:
+            self.packed = np.concatenate([self.packed, np.zeros_like(self.packed)])
+
+        self.packed[self.count] = np.packbits(question.astype(bool), axis=-1)
+        self.count += 1
+
+    def unpack(self) -> "np.ndarray":
+        return np.unpackbits(self.packed[:self.count], axis=-1)[..., :self.choices].astype(bool)
+
+    def analyze(self, answer: "np.ndarray") -> dict:
+        """問題ごとの正答率・選択肢分布・点双列相関を求める"""
+        marks = self.unpack()
+        correct = (marks == answer.astype(bool)).all(axis=2)
+        total = correct.sum(axis=1)
+
+        # 点双列相関 = 正誤 (0/1) と合計点のピアソン相関 (全員正解・全員不正解の問題は nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = correct.mean(axis=0)
+            cov = ((correct - rate) * (total - total.mean())[:, None]).mean(axis=0)
+            correlation = cov / (np.sqrt(rate * (1 - rate)) * total.std())
+
+        return {
+            "correct": correct.sum(axis=0),
+            "rate": rate,
+            "point_biserial": correlation,
+            "blank": (~marks.any(axis=2)).sum(axis=0),
+            "multiple": (marks.sum(axis=2) > 1).sum(axis=0),
+            "options": marks.sum(axis=0),
+        }
+
+
+def write_analysis(f, matrix: AnswerMatrix, answer: "np.ndarray"):
+    options = [str(i + 1) for i in range(matrix.choices)]
+
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(["question", "correct", "rate", "point_biserial", "blank", "multiple"] + options)
+
+    # 採点できたシートがなければ見出しだけ
+    if len(matrix) == 0:
+        return
+
+    stats = matrix.analyze(answer)
+    for i in range(answer.shape[0]):
+        writer.writerow([
+            i + 1,
+            stats["correct"][i],
+            "{:.3f}".format(stats["rate"][i]),
+            "" if np.isnan(stats["point_biserial"][i]) else "{:.3f}".format(stats["point_biserial"][i]),
+            stats["blank"][i],
+            stats["multiple"][i],
+        ] + stats["options"][i].tolist())
+
+
+class WorkQueue(object):
+    """共有ディレクトリ上のロックファイルでシートを取り合い、複数ホストで分担して処理する
+
+    queue/claims/<name>.lock  処理中 (ワーカー名入り、更新時刻が期限の基準)
+    queue/done/<name>         処理済み
+    queue/partial/<worker>.csv ワーカーごとの途中結果
+    """
+
+    FIELDS = ["path", "number", "score", "flag", "digest", "answers", "decode_ms", "track_ms", "grade_ms"]
+
+    def __init__(self, path: Path, worker: str, lease: float):
+        self.path = path
+        self.worker = worker
+        self.lease = lease
+        self.claims = path / "claims"
+        self.done = path / "done"
+        self.partial = path / "partial"
+
+        for d in (self.claims, self.done, self.partial):
+            d.mkdir(parents=True, exist_ok=True)
+
+    def lock(self, p: Path) -> Path:
+        return self.claims / (p.name + ".lock")
+
+    def expired(self, lock: Path) -> bool:
+        try:
+            return time.time() - lock.stat().st_mtime > self.lease
+        except FileNotFoundError:
+            return True
+
+    def claim(self, p: Path) -> bool:
+        lock = self.lock(p)
+
+        for _ in range(2):
+            try:
+                fd = os.open(str(lock), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.expired(lock):
+                    return False
+
+                # 期限切れのロックは改名してから消す (改名できた1台だけが奪える)
+                stale = lock.with_name("{}.{}.stale".format(lock.name, self.worker))
+                try:
+                    os.rename(str(lock), str(stale))
+                except OSError:
+                    return False
+
+                # 改名までの間に他のワーカーが取り直していたら戻す
+                if not self.expired(stale):
+                    os.rename(str(stale), str(lock))
+                    return False
+                os.remove(str(stale))
+            else:
+                with os.fdopen(fd, "w") as f:
+                    f.write(self.worker)
+                return True
+
+        return False
+
+    def finish(self, p: Path):
+        (self.done / p.name).write_text(self.worker)
+
+        # 期限切れで他のワーカーに移ったロックは消さない
+        lock = self.lock(p)
+        try:
+            if lock.read_text() == self.worker:
+                lock.unlink()
+        except FileNotFoundError:
+            pass
+
+    def sheets(self, source: Path, ext: list):
+        while True:
+            pending = False
+            for e in ext:
+                for p in sorted(source.glob("*." + e)):
+                    if (self.done / p.name).exists():
+                        continue
+                    if not self.claim(p):
+                        pending = True
+                        continue
+
+                    # 呼び出し側が次のシートを要求した時点 (=結果記録後) で処理済みにする
+                    yield p, p.read_bytes()
+                    self.finish(p)
+
+            if not pending:
+                return
+
+            # 他のワーカーが処理中のシートは、終わるか期限が切れるまで待つ
+            time.sleep(min(5.0, self.lease / 10))
+
+    def record(self, sheet):
+        f = self.partial / (self.worker + ".csv")
+        with f.open("a", newline="") as f:
+            writer = csv.DictWriter(f, lineterminator="\n", fieldnames=self.FIELDS)
+            if f.tell() == 0:
+                writer.writeheader()
+            writer.writerow({
+                "path": sheet.key,
+                "number": sheet.number,
+                "score": sheet.score,
+                "flag": sheet.flag,
+                "digest": sheet.digest,
+                "answers": "" if sheet.question is None else
+                np.packbits(sheet.question.astype(bool), axis=-1).tobytes().hex(),
+                "decode_ms": sheet.timings.get("decode"),
+                "track_ms": sheet.timings.get("track"),
+                "grade_ms": sheet.timings.get("grade"),
+            })
+            f.flush()
+            os.fsync(f.fileno())
+
+    def merge(self, keep_duplicates: bool) -> (list, list, list, list):
+        """途中結果をまとめて (結果行, マーク, 内容ハッシュ, 処理時間) をシート名順に返す"""
+        rows = []
+        for f in sorted(self.partial.glob("*.csv")):
+            with f.open(newline="") as f:
+                rows.extend(csv.DictReader(f))
+        rows.sort(key=lambda row: row["path"])
+
+        # 重複の判定は処理順に依存しないよう、ここでシート名順に行う
+        index = SheetIndex()
+        result = []
+        positions = {}
+        questions = []
+        digests = []
+        timings = []
+        for row in rows:
+            if result and result[-1]["path"] == row["path"]:
+                continue
+
+            path = Path(row["path"])
+            question = unpack_answers(bytes.fromhex(row["answers"])) if row["answers"] else None
+
+            flag = row["flag"]
+            if question is not None and not keep_duplicates:
+                other = index.findContent(row["digest"], path)
+                conflict = None
+                if other is None:
+                    other, conflict = index.findAnswer(row["number"], question, path)
+                if other is not None:
+                    print("{} skip: duplicate of {}".format(path, other), file=sys.stderr)
+                    continue
+                if conflict is not None:
+                    # 先に取り込んだ側にも印を付ける
+                    flag = add_flag(flag, "conflict:{}".format(conflict.name))
+                    first = result[positions[conflict]]
+                    first["flag"] = add_flag(first["flag"], "conflict:{}".format(path.name))
+
+            positions[path] = len(result)
+            result.append({
+                "number": row["number"],
+                "score": row["score"] and int(row["score"]),
+                "path": row["path"],
+                "flag": flag,
+            })
+            questions.append(question)
+            digests.append(row["digest"])
+            # 処理時間の列がない古い途中結果は空のまま
+            timings.append({
+                stage: float(row[stage + "_ms"])
+                for stage in ("decode", "track", "grade") if row.get(stage + "_ms")
+            })
+
+        return result, questions, digests, timings
+
+
+def unpack_answers(packed: bytes) -> "np.ndarray":
+    packed = np.frombuffer(packed, dtype=np.uint8).reshape(100, -1)
+    return np.unpackbits(packed, axis=-1)[:, :10].astype(int)
+
+
+class ResultStore(object):
+    """採点結果を SQLite に保存する (学籍番号・ファイル名で引けるよう索引を張る)"""
+
+    # まとめて書き込む件数
+    BATCH = 200
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sheets (
+            path TEXT PRIMARY KEY,
+            number TEXT,
+            score INTEGER,
+            form TEXT,
+            flag TEXT,
+            digest TEXT,
+            answers BLOB,
+            decode_ms REAL,
+            track_ms REAL,
+            grade_ms REAL,
+            graded_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS sheets_number ON sheets (number);
+        CREATE INDEX IF NOT EXISTS sheets_form ON sheets (form);
+        CREATE INDEX IF NOT EXISTS sheets_digest ON sheets (digest);
+    """
+
+    def __init__(self, path: Path, readonly: bool = False):
+        self.pending = []
+
+        # 参照だけのときは DB を作ったり書き換えたりしない
+        if readonly:
+            self.conn = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+            return
+
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def add(self, row: dict, question, form: str, digest: str, timings: dict):
+        self.pending.append((
+            row["path"],
+            row["number"],
+            row["score"],
+            form,
+            row["flag"],
+            digest,
+            None if question is None else np.packbits(question.astype(bool), axis=-1).tobytes(),
+            timings.get("decode"),
+            timings.get("track"),
+            timings.get("grade"),
+            time.time(),
+        ))
+        if len(self.pending) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # 再実行時は同じファイルの行を置き換える
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def setFlag(self, path: str, flag: str):
+        self.flush()
+        with self.conn:
+            self.conn.execute("UPDATE sheets SET flag = ? WHERE path = ?", (flag, path))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def lookup(self, number: str) -> list:
+        return self.conn.execute(
+            "SELECT path, number, score, form, flag, answers FROM sheets WHERE number = ? ORDER BY path",
+            (number,)).fetchall()
+
+    def rescore(self, form: str, answer: "np.ndarray") -> int:
+        rows = self.conn.execute("SELECT path, answers FROM sheets WHERE form = ? AND answers IS NOT NULL", (form,)).fetchall()
+        if not rows:
+            return 0
+
+        packed = np.frombuffer(b"".join(a for _, a in rows), dtype=np.uint8).reshape(len(rows), 100, -1)
+        marks = np.unpackbits(packed, axis=-1)[..., :10].astype(bool)
+        scores = (marks == answer.astype(bool)).all(axis=2).sum(axis=1)
+
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE sheets SET score = ? WHERE path = ?",
+                zip(scores.tolist(), (path for path, _ in rows)))
+        return len(rows)
+
+
+# 処理段階ごとの持ち時間 (ms)、sheet は1枚全体
+STAGES = ("decode", "prefilter", "track", "grade", "sheet")
+DEFAULT_BUDGETS = {
+    "track": 500.0,
+    "sheet": 5000.0,
+}
+
+
 class MarkSheetReader(object):
-    def __init__(self, args):
+    def __init__(self, args, answer: list = None):
+        load_modules()
+
         if args.config:
             self.config = self.load_config(args.config)
         else:
             self.config = args
 
-        self.load_answer()
+        if answer is None:
+            self.load_answer()
+        else:
+            self.answer = answer
+        self.index = SheetIndex()
+
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(self.config.budget)
+
+        # 分散処理時の重複判定はマージ時にまとめて行う
+        self.queue = None
+        self.dedup = not self.config.keep_duplicates
+        if self.config.queue is not None:
+            self.queue = WorkQueue(self.config.queue, self.config.worker, self.config.lease)
+            self.dedup = False
 
     def load_config(self, path: Path) -> list:
         pass
 
     def load_answer(self):
-        f = csv.reader(self.config.answer)
+        self.answer = self.parse_answer(self.config.answer)
+
+    @staticmethod
+    def parse_answer(f) -> list:
+        load_modules()
+
+        f = csv.reader(f)
         header = next(f)
 
-        self.answer = []
+        answer = []
         for row in f:
             row = row[1:]
             row = np.asarray(row, dtype=bool).astype(int)
@@ -140,107 +893,610 @@ class MarkSheetReader(object):
             if not row.shape[0] == 10:
                 raise SyntaxError
 
-            self.answer.append(row)
+            answer.append(row)
 
-        if not len(self.answer) == 100:
+        if not len(answer) == 100:
             raise EOFError
 
+        return answer
+
+    def sheets(self):
+        if self.queue is not None:
+            return self.queue.sheets(self.config.input, self.config.ext)
+        return read_sheets(self.config.input, self.config.ext)
+
+    def deadline(self, start: float, stage: str) -> float:
+        budget = self.budgets.get(stage)
+        return None if budget is None else start + budget / 1000
+
+    def overBudget(self, stage: str, timings: dict, deadline: float) -> bool:
+        budget = self.budgets.get(stage)
+        if budget is not None and timings[stage] > budget:
+            return True
+        return deadline is not None and time.perf_counter() > deadline
+
     def __iter__(self):
-        for ext in self.config.ext:
-            for p in self.config.input.glob("*." + ext):
-                parser = MarkSheetParser(p, self.config.thresh)
-                x, y = parser.trackPoisiton()
+        for p, data in self.sheets():
+            timings = {}
+            begin = start = time.perf_counter()
+            deadline = self.deadline(begin, "sheet")
 
-                number = parser.getNumber(x, y)
-                question = parser.getQuestion(x, y)
+            key = sheet_key(self.config.input, p)
+            name = sheet_name(self.config.input, p)
 
-                score = 0
-                for i, q in enumerate(question):
-                    if np.allclose(q, self.answer[i]):
-                        score += 1
+            # 同一ファイルはデコード前に読み飛ばす
+            digest = self.index.contentDigest(data)
+            other = self.index.findContent(digest, p)
+            if other is not None and self.dedup:
+                print("{} skip: duplicate of {}".format(p, other), file=sys.stderr)
+                continue
 
-                yield MarkSheetResult(
+            # 途中で打ち切ったシートも、そこまでの結果を付けて返す
+            def partial(flag, **kargs):
+                timings["total"] = (time.perf_counter() - begin) * 1000
+                return MarkSheetResult(
                     path=p,
-                    number=number,
-                    question=question,
-                    score=score,
-                    x=x,
-                    y=y,
-                    image=parser.image
+                    key=key,
+                    name=name,
+                    data=data,
+                    digest=digest,
+                    flag=";".join(flags + [flag]),
+                    timings=timings,
+                    rotated=parser is not None and parser.rotated,
+                    **kargs
                 )
 
-        raise StopIteration
+            # 壊れたファイルや画像でないファイルは弾いて次のシートへ進む
+            flags = []
+            parser = None
+            try:
+                parser = MarkSheetParser(data, self.config.thresh)
+            except OSError:
+                timings["decode"] = (time.perf_counter() - start) * 1000
+                yield partial("rejected:unreadable")
+                continue
+            timings["decode"] = (time.perf_counter() - start) * 1000
 
+            if self.overBudget("decode", timings, deadline):
+                yield partial("review:decode")
+                continue
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="CLI Mode Marksheet parser")
-    parser.add_argument("-i", "--input", type=open_dir, required=True, help="input directory")
-    parser.add_argument("-o", "--output", type=open_dir, required=True, help="output directory")
-    parser.add_argument("-r", "--result", type=argparse.FileType("w"), required=True, help="result file")
-    parser.add_argument("-t", "--thresh", type=int, required=False, default=240, help="threshold value")
-    parser.add_argument("-e", "--ext", type=str, required=False, default=["jpg", "png", "gif"], nargs="+",
-                        help="target file extension")
-    parser.add_argument("-a", "--answer", type=argparse.FileType("r"), required=True, help="answer csv file")
-    parser.add_argument("-c", "--config", type=argparse.FileType("r"), required=False, help="config file path TBD")
+            # 白紙や別の用紙は重いマーカー探索の前に弾く
+            start = time.perf_counter()
+            reason = parser.classify()
+            timings["prefilter"] = (time.perf_counter() - start) * 1000
 
-    # TODO: argparse
-    POSITION_MARKER = (255, 0, 0)
-    POSITION_MARKER_LINE = (0, 0, 255)
-    ANSWER_MARKER = (0, 255, 0)
+            flags = ["rotated"] if parser.rotated else []
+            if reason:
+                yield partial("rejected:" + reason)
+                continue
+            if self.overBudget("prefilter", timings, deadline):
+                yield partial("review:prefilter")
+                continue
 
-    args = parser.parse_args()
+            # 持ち時間を超えたら粗い探索に切り替わる
+            start = time.perf_counter()
+            track_deadline = self.deadline(start, "track")
+            if deadline is not None:
+                track_deadline = min(deadline, track_deadline or deadline)
+            try:
+                x, y = parser.trackPoisiton(track_deadline)
+            except IndexError:
+                timings["track"] = (time.perf_counter() - start) * 1000
+                yield partial("rejected:unreadable", x=parser.markers_x, y=parser.markers_y)
+                continue
+            timings["track"] = (time.perf_counter() - start) * 1000
 
-    reader = MarkSheetReader(args)
+            if parser.coarse:
+                flags.append("coarse")
+            if deadline is not None and time.perf_counter() > deadline:
+                yield partial("review:track", x=x, y=y, image=parser.image)
+                continue
 
-    result = []
-    for sheet in reader:
-        print(sheet.path, sheet)
-        result.append({
-            "number": sheet.number,
-            "score": sheet.score,
-        })
-
-        h, w = sheet.image.shape
-        image = np.array(Image.open(sheet.path.open("rb")))
-        # 結果書き込み
-
-        # TODO: fix
-        for x in sheet.x[:7]:
-            for number, y in enumerate(sheet.y[:10]):
+            start = time.perf_counter()
+            number = parser.getNumber(x, y)
+            question = parser.getQuestion(x, y)
+
+            # マークまで同じなら再給紙とみなし、学籍番号だけ同じなら要確認
+            if not self.index.completeNumber(number):
+                flags.append("no-number")
+            other, conflict = self.index.findAnswer(number, question, p)
+            if other is not None and self.dedup:
+                print("{} skip: duplicate of {}".format(p, other), file=sys.stderr)
+                continue
+            if not self.dedup:
+                conflict = None
+            if conflict is not None:
+                flags.append("conflict:{}".format(conflict.name))
+
+            score = 0
+            for i, q in enumerate(question):
+                if np.allclose(q, self.answer[i]):
+                    score += 1
+            timings["grade"] = (time.perf_counter() - start) * 1000
+
+            # 採点は済んでいるので結果はそのまま付け、要確認の印だけ付ける
+            if self.overBudget("grade", timings, deadline):
+                flags.append("review:grade")
+
+            timings["total"] = (time.perf_counter() - begin) * 1000
+            yield MarkSheetResult(
+                path=p,
+                key=key,
+                name=name,
+                data=data,
+                digest=digest,
+                number=number,
+                question=question,
+                score=score,
+                x=x,
+                y=y,
+                image=parser.image,
+                flag=";".join(flags),
+                timings=timings,
+                rotated=parser.rotated,
+                conflict=conflict
+            )
+
+
+# TODO: argparse
+POSITION_MARKER = (255, 0, 0)
+POSITION_MARKER_LINE = (0, 0, 255)
+ANSWER_MARKER = (0, 255, 0)
+
+
+def draw_result(image: "np.ndarray", sheet: MarkSheetResult) -> "np.ndarray":
+    h, w = sheet.image.shape
+    radius = int(w * 0.01)
+    border = int(radius / 3)
+
+    for x in sheet.x[:7]:
+        for number, y in enumerate(sheet.y[:10]):
+            if sheet.image[y[1]][x[0]]:
+                cv2.circle(image, (x[0], y[1]), radius, POSITION_MARKER, border)
+                cv2.putText(
+                    image,
+                    str(number),
+                    (x[0] - int(radius/2), y[1] + int(radius/2)),
+                    cv2.FONT_HERSHEY_COMPLEX,
+                    fontScale=int(border / 5),
+                    color=POSITION_MARKER,
+                    thickness=border)
+                break
+
+    for i, v in enumerate(list(zip(*[iter(sheet.x[7:])]*10))):
+        for y in sheet.y:
+            # 交点位置を参照して色が塗られてるかチェック
+            for number, x in enumerate(v):
+                # マークされていたら1
                 if sheet.image[y[1]][x[0]]:
-                    radius = int(w * 0.01)
-                    border = int(radius / 3)
                     cv2.circle(image, (x[0], y[1]), radius, POSITION_MARKER, border)
                     cv2.putText(
                         image,
-                        str(number),
+                        str(number + 1),
                         (x[0] - int(radius/2), y[1] + int(radius/2)),
                         cv2.FONT_HERSHEY_COMPLEX,
                         fontScale=int(border / 5),
                         color=POSITION_MARKER,
                         thickness=border)
-                    break
 
-        for i, v in enumerate(list(zip(*[iter(sheet.x[7:])]*10))):
-            for y in sheet.y:
-                # 交点位置を参照して色が塗られてるかチェック
-                for number, x in enumerate(v):
-                    # マークされていたら1
-                    if sheet.image[y[1]][x[0]]:
-                        cv2.circle(image, (x[0], y[1]), radius, POSITION_MARKER, border)
-                        cv2.putText(
-                            image,
-                            str(number + 1),
-                            (x[0] - int(radius/2), y[1] + int(radius/2)),
-                            cv2.FONT_HERSHEY_COMPLEX,
-                            fontScale=int(border / 5),
-                            color=POSITION_MARKER,
-                            thickness=border)
-
-        # 書き出し
-        output = args.output / sheet.path.name
-        Image.fromarray(image).save(output)
-
-    writer = csv.DictWriter(args.result, lineterminator="\n", fieldnames=result[0].keys())
+    return image
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="CLI Mode Marksheet parser")
+    parser.add_argument("-i", "--input", type=open_input, required=False,
+                        help="input directory, zip/tar archive or - for a tar/zip stream on stdin")
+    parser.add_argument("-o", "--output", type=open_output, required=False,
+                        help="output directory, zip/tar archive or - for a tar stream on stdout")
+    parser.add_argument("-r", "--result", type=argparse.FileType("w"), required=False, help="result file")
+    parser.add_argument("-t", "--thresh", type=int, required=False, default=240, help="threshold value")
+    parser.add_argument("-e", "--ext", type=str, required=False, default=["jpg", "png", "gif"], nargs="+",
+                        help="target file extension")
+    parser.add_argument("-a", "--answer", type=argparse.FileType("r"), required=False, help="answer csv file")
+    parser.add_argument("--rejected", type=open_output, required=False,
+                        help="directory or archive that receives rejected and needs-review pages")
+    parser.add_argument("--budget", type=parse_budget, required=False, default=[], nargs="+", metavar="STAGE=MS",
+                        help="time budget per stage ({}), default track=500 sheet=5000".format(", ".join(STAGES)))
+    parser.add_argument("--analysis", type=argparse.FileType("w"), required=False,
+                        help="item analysis csv file (per question difficulty, discrimination and distractors)")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="grade and output duplicate scans instead of skipping them")
+    parser.add_argument("--queue", type=Path, required=False, metavar="DIR",
+                        help="shared work queue directory; several workers on the same --input split the batch")
+    parser.add_argument("--worker", type=str, required=False,
+                        default="{}-{}".format(socket.gethostname(), os.getpid()), help="worker name in --queue")
+    parser.add_argument("--lease", type=float, required=False, default=300,
+                        help="seconds after which a claimed sheet of a dead worker is taken over")
+    parser.add_argument("--merge", action="store_true",
+                        help="merge the partial results in --queue into --result and exit")
+    parser.add_argument("--db", type=Path, required=False,
+                        help="SQLite result store; rows are upserted by file so reruns replace old results")
+    parser.add_argument("--form", type=str, required=False,
+                        help="form name stored with the results (default: answer file name)")
+    parser.add_argument("--lookup", type=str, required=False, metavar="NUMBER",
+                        help="print the stored results of a student number from --db and exit")
+    parser.add_argument("--rescore", action="store_true",
+                        help="recompute the scores of --form in --db against --answer and exit")
+    parser.add_argument("--serve", type=Path, required=False, metavar="SOCKET",
+                        help="stay resident and accept jobs on the unix socket SOCKET (mode 0600)")
+    parser.add_argument("--connect", type=Path, required=False, metavar="SOCKET",
+                        help="send this job to a server started with --serve")
+    parser.add_argument("-c", "--config", type=argparse.FileType("r"), required=False, help="config file path TBD")
+    return parser
+
+
+def uses_stdio(args) -> bool:
+    """標準入出力を使う引数があるか (サーバー側の標準入出力は使わせない)"""
+    return ("-" in (args.input, args.output, args.rejected)
+            or sys.stdout in (args.result, args.analysis)
+            or args.answer is sys.stdin)
+
+
+def check_args(parser: argparse.ArgumentParser, args):
+    if (args.serve is not None or args.connect is not None) and not hasattr(socket, "AF_UNIX"):
+        parser.error("--serve/--connect require unix domain sockets")
+
+    if args.serve is not None:
+        if args.answer is None:
+            parser.error("--serve requires --answer")
+        return
+
+    if args.lookup is not None:
+        required = ["db"]
+    elif args.rescore:
+        required = ["db", "answer"]
+    elif args.merge:
+        required = ["queue", "result"] + (["answer"] if args.analysis else [])
+    elif args.queue is not None:
+        required = ["input", "output", "answer"]
+    else:
+        required = ["input", "output", "result", "answer"]
+
+    missing = [name for name in required if getattr(args, name) is None]
+    if missing:
+        parser.error("the following arguments are required: " + ", ".join("--" + name for name in missing))
+
+    # 参照・再採点で空の DB を作らない
+    if (args.lookup is not None or args.rescore) and not args.db.is_file():
+        parser.error("not exists : {}".format(args.db))
+
+    if args.output == "-" and sys.stdout in (args.result, args.analysis):
+        parser.error("--output and --result/--analysis cannot both be stdout")
+
+    if args.rejected == "-" and (args.output == "-" or sys.stdout in (args.result, args.analysis)):
+        parser.error("--rejected cannot share stdout with another output")
+
+    if args.connect is not None and uses_stdio(args):
+        parser.error("stdin/stdout streams cannot be used with --connect")
+
+    if args.queue is not None and not args.merge and (args.input == "-" or not args.input.is_dir()):
+        parser.error("--queue requires an input directory")
+
+    # 共有ディスク上の SQLite に複数ホストから書かないよう、分散時はマージでだけ使う
+    if args.queue is not None and not args.merge and args.db is not None:
+        parser.error("--db can only be used with --merge when --queue is given")
+
+
+def write_result(f, result: list):
+    writer = csv.DictWriter(f, lineterminator="\n", fieldnames=["number", "score", "path", "flag"])
     writer.writeheader()
     writer.writerows(result)
+    f.flush()
+
+
+def form_name(args) -> str:
+    if args.form:
+        return args.form
+    if args.answer is not None:
+        return Path(args.answer.name).stem
+    return ""
+
+
+def report_latency(timings: list):
+    if not timings:
+        return
+
+    # 1枚あたりの処理時間 (読み取り〜書き出し) と段階ごとの p99
+    total = [t.get("total", 0) + t.get("output", 0) for t in timings]
+    p50, p99 = np.percentile(total, [50, 99])
+    print("{} sheets  p50: {:.1f} ms  p99: {:.1f} ms  max: {:.1f} ms".format(
+        len(total), p50, p99, max(total)), file=sys.stderr)
+
+    stages = []
+    for stage in STAGES[:-1] + ("output",):
+        values = [t[stage] for t in timings if stage in t]
+        if values:
+            stages.append("{}: {:.1f} ms".format(stage, np.percentile(values, 99)))
+    print("p99 by stage  " + "  ".join(stages), file=sys.stderr)
+
+
+def run(args, reader: MarkSheetReader):
+    matrix = AnswerMatrix()
+
+    result = []
+    rows = {}
+    timings = []
+    # 途中で失敗しても書きかけの行を DB に残し、アーカイブは閉じておく
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(SheetWriter(args.output))
+        rejected = stack.enter_context(SheetWriter(args.rejected)) if args.rejected is not None else None
+        store = stack.enter_context(ResultStore(args.db)) if args.db is not None else None
+
+        for sheet in reader:
+            print(sheet.path, sheet, file=sys.stderr)
+            timings.append(sheet.timings)
+            if reader.queue is not None:
+                reader.queue.record(sheet)
+            result.append({
+                "number": sheet.number,
+                "score": sheet.score,
+                "path": sheet.key,
+                "flag": sheet.flag,
+            })
+            rows[sheet.path] = result[-1]
+            if store is not None:
+                store.add(result[-1], sheet.question, form_name(args), sheet.digest, sheet.timings)
+
+            # 先に取り込んだ側のシートにも要確認の印を付ける
+            if sheet.conflict is not None:
+                row = rows[sheet.conflict]
+                row["flag"] = add_flag(row["flag"], "conflict:{}".format(sheet.path.name))
+                if store is not None:
+                    store.setFlag(row["path"], row["flag"])
+
+            # 弾いたページはそのまま別の出力先へ
+            if sheet.question is None:
+                if rejected is not None:
+                    rejected.write(sheet.name, sheet.data)
+                continue
+            matrix.append(sheet.question)
+
+            # 結果書き込み
+            start = time.perf_counter()
+            image = decode_image(sheet.data, cv2.IMREAD_COLOR)
+            if sheet.rotated:
+                image = cv2.rotate(image, cv2.ROTATE_180)
+            image = draw_result(image, sheet)
+
+            # 書き出し
+            writer.write(sheet.name, encode_image(image, sheet.path.suffix))
+            sheet.timings["output"] = (time.perf_counter() - start) * 1000
+
+    report_latency(timings)
+
+    if args.result:
+        write_result(args.result, result)
+
+    if args.analysis:
+        write_analysis(args.analysis, matrix, np.asarray(reader.answer))
+        args.analysis.flush()
+
+
+def merge(args, answer: list = None):
+    load_modules()
+
+    queue = WorkQueue(args.queue, args.worker, args.lease)
+    result, questions, digests, timings = queue.merge(args.keep_duplicates)
+    write_result(args.result, result)
+
+    if args.db is not None:
+        with ResultStore(args.db) as store:
+            for row, question, digest, t in zip(result, questions, digests, timings):
+                store.add(row, question, form_name(args), digest, t)
+
+    if args.analysis:
+        if answer is None:
+            answer = MarkSheetReader.parse_answer(args.answer)
+
+        matrix = AnswerMatrix()
+        for question in questions:
+            if question is not None:
+                matrix.append(question)
+        write_analysis(args.analysis, matrix, np.asarray(answer))
+        args.analysis.flush()
+
+
+def lookup(args):
+    load_modules()
+
+    with ResultStore(args.db, readonly=True) as store:
+        rows = store.lookup(args.lookup)
+
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerow(["path", "number", "score", "form", "flag"] + [str(i + 1) for i in range(100)])
+    for path, number, score, form, flag, answers in rows:
+        # 問題ごとにマークした選択肢を "/" でつなぐ
+        marks = []
+        if answers is not None:
+            marks = ["/".join(str(c + 1) for c in np.flatnonzero(q)) for q in unpack_answers(answers)]
+        writer.writerow([path, number, score, form, flag] + marks)
+
+
+def rescore(args, answer: list = None):
+    load_modules()
+
+    if answer is None:
+        answer = MarkSheetReader.parse_answer(args.answer)
+
+    with ResultStore(args.db) as store:
+        count = store.rescore(form_name(args), np.asarray(answer))
+    print("rescored {} sheets of form {}".format(count, form_name(args)), file=sys.stderr)
+
+
+def main(args, answer: list = None):
+    if args.lookup is not None:
+        lookup(args)
+    elif args.rescore:
+        rescore(args, answer)
+    elif args.merge:
+        merge(args, answer)
+    else:
+        run(args, MarkSheetReader(args, answer=answer))
+
+
+class SocketLog(object):
+    """ログを1行ずつ JSON にしてクライアントへ送る"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.buffer = ""
+
+    def write(self, text: str) -> int:
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            self.send(log=line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def send(self, **message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+
+class GradingHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # 起動時の生存確認などジョブを送らずに切れた接続は無視する
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        job = json.loads(line.decode())
+        log = SocketLog(self.wfile)
+
+        args = None
+        status = 0
+        cwd = os.getcwd()
+        with contextlib.redirect_stderr(log):
+            try:
+                os.chdir(job["cwd"])
+                args = self.server.parser.parse_args(job["argv"])
+                check_args(self.server.parser, args)
+                if uses_stdio(args):
+                    self.server.parser.error("stdin/stdout streams cannot be used with --connect")
+
+                main(args, self.server.compileAnswer(args.answer) if args.answer else None)
+            except SystemExit as e:
+                status = e.code
+            except Exception as e:
+                print("error: {!r}".format(e), file=sys.stderr)
+                status = 1
+            finally:
+                # サーバー自身の標準入出力は閉じない
+                for f in ("result", "analysis", "answer"):
+                    f = getattr(args, f, None)
+                    if f is not None and f not in (sys.stdin, sys.stdout, sys.stderr):
+                        f.close()
+                os.chdir(cwd)
+
+        log.send(status=status)
+
+
+class GradingServer(socketserver.TCPServer):
+    """OpenCV と解答を読み込んだまま常駐し、--connect からのジョブを処理する
+
+    ジョブは任意のパスを読み書きできるので、本人だけが接続できる unix ソケットで受ける
+    """
+
+    # socketserver.UnixStreamServer と同じ (AF_UNIX のない環境でも import はできるように)
+    address_family = getattr(socket, "AF_UNIX", None)
+
+    def __init__(self, path: Path, parser: argparse.ArgumentParser, answer):
+        # ジョブごとに作業ディレクトリが変わるので絶対パスで持つ
+        path = path.absolute()
+        self.removeStale(path)
+
+        # bind に失敗したときに既存のファイルを消さないよう、消すのは自分で作ったソケットだけ
+        self.path = None
+
+        # bind した時点から本人以外は接続できないようにする
+        umask = os.umask(0o177)
+        try:
+            super(GradingServer, self).__init__(str(path), GradingHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        os.chmod(str(path), 0o600)
+
+        self.parser = parser
+        self.answers = {}
+
+        load_modules()
+        self.compileAnswer(answer)
+
+    @staticmethod
+    def removeStale(path: Path):
+        """前回異常終了したサーバーのソケットが残っていれば消す"""
+        if not path.is_socket():
+            return
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(str(path))
+            except ConnectionRefusedError:
+                path.unlink()
+            else:
+                raise OSError("another server is listening on {}".format(path))
+
+    def server_close(self):
+        super(GradingServer, self).server_close()
+        if self.path is None:
+            return
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def compileAnswer(self, f) -> list:
+        # 同じファイルが更新されていなければ前回の解析結果を使う
+        key = (os.path.realpath(f.name), os.fstat(f.fileno()).st_mtime)
+        if key not in self.answers:
+            self.answers[key] = MarkSheetReader.parse_answer(f)
+        return self.answers[key]
+
+
+def connect(path: Path, argv: list) -> int:
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(str(path))
+        f = sock.makefile("rwb")
+        f.write((json.dumps({"cwd": os.getcwd(), "argv": argv}) + "\n").encode())
+        f.flush()
+
+        for line in f:
+            message = json.loads(line.decode())
+            if "log" in message:
+                print(message["log"], file=sys.stderr)
+            else:
+                return message["status"]
+
+    return 1
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+
+    if args.serve is not None:
+        try:
+            server = GradingServer(args.serve, parser, args.answer)
+        except OSError as e:
+            parser.error(str(e))
+        print("listening on {}".format(server.path), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif args.connect is not None:
+        # --connect 以外の引数をそのままサーバーに渡す
+        pre = argparse.ArgumentParser(add_help=False)
+        pre.add_argument("--connect")
+        _, argv = pre.parse_known_args()
+        sys.exit(connect(args.connect, argv))
+    else:
+        main(args)